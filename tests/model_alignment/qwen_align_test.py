@@ -2,13 +2,16 @@
 
 The test will compare the first N decoder layer output between Tunix model and
 HF PyTorch model, typically we will expect the logits differnece to be within
-1e-3 in fp32.
+1e-3 in fp32 and 5e-2 in bf16.
 """
 
+import concurrent.futures
+import functools
 import os
 import tempfile
 from absl.testing import absltest
 from absl.testing import parameterized
+from flax import nnx
 import jax
 import jax.numpy as jnp
 import numpy as np
@@ -21,6 +24,50 @@ from tunix.tests import test_common as tc
 
 K_MASK = -2.3819763e38
 
+_TORCH_DTYPES = {
+    jnp.float32: torch.float32,
+    jnp.bfloat16: torch.bfloat16,
+}
+
+_TEST_CASES = (
+    dict(
+        testcase_name="deepseek_r1_distill_qwen_1_5b",
+        model_name="deepseek-ai/DeepSeek-R1-Distill-Qwen-1.5B",
+        model_config=qwen2_model.ModelConfig.deepseek_r1_distill_qwen_1_5b,
+        tolerance=2e-3,
+        dtype=jnp.float32,
+    ),
+    dict(
+        testcase_name="qwen2_5_1_5b_instruct",
+        model_name="Qwen/Qwen2.5-1.5B-Instruct",
+        model_config=qwen2_model.ModelConfig.qwen2_5_1_5b,
+        tolerance=1e-3,
+        dtype=jnp.float32,
+    ),
+    # Both models in bf16, weights and activations. On 28-layer toy models
+    # the comparison needed up to ~2.6e-2; the tolerance leaves 2x headroom.
+    dict(
+        testcase_name="deepseek_r1_distill_qwen_1_5b_bf16",
+        model_name="deepseek-ai/DeepSeek-R1-Distill-Qwen-1.5B",
+        model_config=qwen2_model.ModelConfig.deepseek_r1_distill_qwen_1_5b,
+        tolerance=5e-2,
+        dtype=jnp.bfloat16,
+    ),
+    dict(
+        testcase_name="qwen2_5_1_5b_instruct_bf16",
+        model_name="Qwen/Qwen2.5-1.5B-Instruct",
+        model_config=qwen2_model.ModelConfig.qwen2_5_1_5b,
+        tolerance=5e-2,
+        dtype=jnp.bfloat16,
+    ),
+    # Note: Qwen/Qwen2.5-7B-Instruct will OOM on v5e-8 in fp32.
+)
+_MODEL_NAMES = tuple(sorted({case["model_name"] for case in _TEST_CASES}))
+
+
+def _model_path(model_name: str) -> str:
+  return os.path.join(tempfile.gettempdir(), "models", model_name)
+
 
 def create_pytorch_causal_mask(seq_len):
   """Creates a causal attention mask for a sequence of a given length.
@@ -29,53 +76,73 @@ def create_pytorch_causal_mask(seq_len):
     seq_len: The length of the sequence.
 
   Returns:
-    A boolean tensor of shape (seq_len, seq_len) where:
-    - mask[i, j] is True if token i can attend to token j (j <= i).
-    - mask[i, j] is False if token i cannot attend to token j (j > i).
+    A float32 tensor of shape (seq_len, seq_len) where:
+    - mask[i, j] is 0 if token i can attend to token j (j <= i).
+    - mask[i, j] is K_MASK if token i cannot attend to token j (j > i).
   """
-  # Create a lower triangular matrix of ones
-  mask = torch.ones(seq_len, seq_len, dtype=torch.float).tril(diagonal=0)
-  mask = mask.masked_fill(mask == 0, K_MASK)
-  mask = mask.masked_fill(mask == 1, 0)
-  return mask
+  idx = torch.arange(seq_len)
+  mask_bool = idx[:, None] >= idx[None, :]
+  return torch.where(
+      mask_bool,
+      torch.zeros((), dtype=torch.float32),
+      torch.full((), K_MASK, dtype=torch.float32),
+  )
+
+
+@functools.lru_cache(maxsize=8)
+def _causal_mask_4d(seq_len: int, dtype: torch.dtype = torch.float32):
+  """Returns the causal mask broadcast to (1, 1, seq_len, seq_len)."""
+  mask = create_pytorch_causal_mask(seq_len).unsqueeze(0).unsqueeze(0)
+  return mask.to(dtype)
 
 
 def get_hf_output(model, seq_len: int):
-  x = (torch.arange(seq_len) + 1).reshape(1, -1)
-  position_ids = torch.arange(seq_len).reshape(1, -1)
-  attn_mask = create_pytorch_causal_mask(seq_len).unsqueeze(0).unsqueeze(0)
-  return model(x, attn_mask, position_ids).logits.detach().numpy()
+  with torch.inference_mode():
+    x = (torch.arange(seq_len) + 1).reshape(1, -1)
+    position_ids = torch.arange(seq_len).reshape(1, -1)
+    attn_mask = _causal_mask_4d(seq_len, model.dtype)
+    logits = model(x, attn_mask, position_ids).logits
+    return logits.to(torch.float32).numpy()
 
 
-def get_jax_output(model, seq_len: int):
+@functools.partial(nnx.jit, static_argnames=("seq_len",))
+def _jax_forward(model, seq_len: int):
   x = (jnp.arange(seq_len) + 1).reshape(1, -1)
   positions = jnp.arange(seq_len).reshape(1, -1)
   attn_mask = utils.make_causal_attn_mask(jnp.ones((1, seq_len)))
   output, _ = model(x, positions, None, attn_mask)
-  return output
+  return output.astype(jnp.float32)
+
+
+def get_jax_output(model, seq_len: int):
+  return _jax_forward(model, seq_len).block_until_ready()
 
 
 def get_per_layer_hf_output(model, seq_len: int, num_layer_to_run: int = 1):
   """Get the first decoder layer output from the HF model."""
-  x = (torch.arange(seq_len) + 1).reshape(1, -1)
-  position_ids = torch.arange(seq_len).reshape(1, -1)
-  attn_mask = create_pytorch_causal_mask(seq_len).unsqueeze(0).unsqueeze(0)
+  with torch.inference_mode():
+    x = (torch.arange(seq_len) + 1).reshape(1, -1)
+    position_ids = torch.arange(seq_len).reshape(1, -1)
+    attn_mask = _causal_mask_4d(seq_len, model.dtype)
 
-  m = model.get_decoder()
-  emb = m.embed_tokens(x)
-  position_embeddings = m.rotary_emb(emb, position_ids)
+    m = model.get_decoder()
+    emb = m.embed_tokens(x)
+    position_embeddings = m.rotary_emb(emb, position_ids)
 
-  logits = emb
-  for i in range(num_layer_to_run):
-    logits = m.layers[i](
-        logits, attn_mask, position_ids, position_embeddings=position_embeddings
-    )
+    logits = emb
+    for i in range(num_layer_to_run):
+      logits = m.layers[i](
+          logits,
+          attn_mask,
+          position_ids,
+          position_embeddings=position_embeddings,
+      )
 
-  return logits[0].detach().numpy()
+    return logits[0].to(torch.float32).numpy()
 
 
-def get_per_layer_jax_output(model, seq_len: int, num_layer_to_run: int = 1):
-  """Get the first decoder layer output from the Tunix model."""
+@functools.partial(nnx.jit, static_argnames=("seq_len", "num_layer_to_run"))
+def _per_layer_jax_forward(model, seq_len: int, num_layer_to_run: int):
   x = (jnp.arange(seq_len) + 1).reshape(1, -1)
   positions = jnp.arange(seq_len).reshape(1, -1)
   attn_mask = utils.make_causal_attn_mask(jnp.ones((1, seq_len)))
@@ -84,36 +151,58 @@ def get_per_layer_jax_output(model, seq_len: int, num_layer_to_run: int = 1):
   )
 
   logits = model.embedder.encode(x)
+  sin, cos = sin.astype(logits.dtype), cos.astype(logits.dtype)
   for i in range(num_layer_to_run):
     _, logits = model.layers[i](logits, None, attn_mask, sin, cos)
 
-  return logits
+  return logits.astype(jnp.float32)
 
 
-class QwenAlignTest(parameterized.TestCase):
+def get_per_layer_jax_output(model, seq_len: int, num_layer_to_run: int = 1):
+  """Get the first decoder layer output from the Tunix model."""
+  return _per_layer_jax_forward(
+      model, seq_len, num_layer_to_run
+  ).block_until_ready()
 
-  @parameterized.named_parameters(
-      dict(
-          testcase_name="deepseek_r1_distill_qwen_1_5b",
-          model_name="deepseek-ai/DeepSeek-R1-Distill-Qwen-1.5B",
-          model_config=qwen2_model.ModelConfig.deepseek_r1_distill_qwen_1_5b,
-          tolerance=2e-3,
-      ),
-      dict(
-          testcase_name="qwen2_5_1_5b_instruct",
-          model_name="Qwen/Qwen2.5-1.5B-Instruct",
-          model_config=qwen2_model.ModelConfig.qwen2_5_1_5b,
-          tolerance=1e-3,
-      ),
-      # Note: Qwen/Qwen2.5-7B-Instruct will OOM on v5e-8.
-  )
-  def test_qwen_model_alignment(self, model_name, model_config, tolerance):
-    model_path = os.path.join(tempfile.gettempdir(), "models", model_name)
 
-    tc.download_from_huggingface(repo_id=model_name, model_path=model_path)
+class QwenAlignTest(parameterized.TestCase):
+
+  # Maps model_name to the local checkpoint path, filled in by setUpClass.
+  _model_paths: dict[str, str] = {}
+
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    # Download all checkpoints concurrently before the first test runs.
+    model_paths = {name: _model_path(name) for name in _MODEL_NAMES}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(model_paths)
+    ) as executor:
+      futures = [
+          executor.submit(
+              tc.download_from_huggingface, repo_id=name, model_path=path
+          )
+          for name, path in model_paths.items()
+      ]
+      for future in futures:
+        future.result()
+    cls._model_paths.update(model_paths)
+
+  @classmethod
+  def tearDownClass(cls):
+    for model_path in cls._model_paths.values():
+      tc.delete_directory(model_path)
+    cls._model_paths.clear()
+    super().tearDownClass()
+
+  @parameterized.named_parameters(*_TEST_CASES)
+  def test_qwen_model_alignment(
+      self, model_name, model_config, tolerance, dtype
+  ):
+    model_path = self._model_paths[model_name]
 
     hf_model = transformers.AutoModelForCausalLM.from_pretrained(
-        model_path, dtype=torch.float32
+        model_path, dtype=_TORCH_DTYPES[dtype]
     )
     print("HF model loaded.")
 
@@ -121,55 +210,75 @@ class QwenAlignTest(parameterized.TestCase):
         model_path,
         model_config(),
         mesh=jax.make_mesh((1, 1), ("fsdp", "tp")),
-        dtype=jnp.float32,
+        dtype=dtype,
     )
     print("JAX model loaded.")
 
-    # Make sure model weights are the same (only check the first query weight)
-    hf_query_weight = (
-        hf_model.get_decoder()
-        .layers[0]
-        .self_attn.q_proj.weight.detach()
-        .numpy()
-    )
-    jax_query_weight = jax_model.layers[0].attn.q_proj.w
-    d, _, _ = jax_query_weight.shape
-    jax_query_weight = jax_query_weight.reshape(d, -1).transpose()
-    np.testing.assert_equal(
-        hf_query_weight,
-        jax_query_weight,
-        err_msg=(
-            "Query weights are not equal, are you sure the loaded model weight"
-            " between HF and JAX is identical?"
-        ),
-    )
+    # Make sure model weights are the same (only check the first query weight).
+    # Only meaningful when both sides are loaded in fp32.
+    if dtype == jnp.float32:
+      hf_query_weight = (
+          hf_model.get_decoder()
+          .layers[0]
+          .self_attn.q_proj.weight.detach()
+          .numpy()
+      )
+      jax_query_weight = jax_model.layers[0].attn.q_proj.w
+      d, _, _ = jax_query_weight.shape
+      jax_query_weight = jax_query_weight.reshape(d, -1).transpose()
+      np.testing.assert_equal(
+          hf_query_weight,
+          jax_query_weight,
+          err_msg=(
+              "Query weights are not equal, are you sure the loaded model"
+              " weight between HF and JAX is identical?"
+          ),
+      )
 
     seq_len = 128
+    # The per-layer check runs every decoder layer; a shorter sequence keeps its
+    # attention cost down while the full model check still uses `seq_len`.
+    per_layer_seq_len = 64
 
     layer_to_run = model_config().num_layers
-    hf_logits = get_per_layer_hf_output(hf_model, seq_len, layer_to_run)
-    jax_logits = get_per_layer_jax_output(jax_model, seq_len, layer_to_run)
-    np.testing.assert_allclose(
-        hf_logits.squeeze(),
-        jax_logits.squeeze(),
-        atol=tolerance,
-        rtol=tolerance,
+    hf_logits = get_per_layer_hf_output(
+        hf_model, per_layer_seq_len, layer_to_run
+    )
+    jax_logits = get_per_layer_jax_output(
+        jax_model, per_layer_seq_len, layer_to_run
     )
 
     # Do a check on entire model output
     hf_output = get_hf_output(hf_model, seq_len)
     jax_output = get_jax_output(jax_model, seq_len)
-    np.testing.assert_allclose(
-        hf_output.squeeze(),
-        jax_output.squeeze(),
-        atol=tolerance,
-        rtol=tolerance,
-    )
 
-    print("Logits are close! Model alignment check passed :)")
+    separate_checks = os.environ.get("ALIGN_SEPARATE_CHECKS", "").lower()
+    if separate_checks in ("1", "true", "yes"):
+      # Report per-layer and full model mismatches separately, for debugging.
+      np.testing.assert_allclose(
+          hf_logits.squeeze(),
+          jax_logits.squeeze(),
+          atol=tolerance,
+          rtol=tolerance,
+      )
+      np.testing.assert_allclose(
+          hf_output.squeeze(),
+          jax_output.squeeze(),
+          atol=tolerance,
+          rtol=tolerance,
+      )
+    else:
+      np.testing.assert_allclose(
+          np.concatenate([hf_logits.ravel(), hf_output.ravel()]),
+          np.concatenate([
+              np.asarray(jax_logits).ravel(),
+              np.asarray(jax_output).ravel(),
+          ]),
+          atol=tolerance,
+          rtol=tolerance,
+      )
 
-    # clean up
-    tc.delete_directory(model_path)
+    print("Logits are close! Model alignment check passed :)")
 
 
 if __name__ == "__main__":
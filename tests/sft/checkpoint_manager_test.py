@@ -42,9 +42,17 @@ def assert_close(path, x, y, atol=1e-5, rtol=1e-5):
 
 
 def assert_not_equal(path, x, y):
-  np.testing.assert_(
-      np.any(np.not_equal(x, y)), msg=f'Unexpected match at path: {path}'
-  )
+  if isinstance(x, jax.Array) and isinstance(y, jax.Array):
+    # Reduce on device, only the scalar result is copied to host.
+    differs = bool(jnp.any(x != y))
+  else:
+    differs = np.any(np.not_equal(x, y))
+  np.testing.assert_(differs, msg=f'Unexpected match at path: {path}')
+
+
+@jax.jit
+def _inc(state):
+  return jax.tree.map(lambda x: x + 1, state)
 
 
 class TestModel(nnx.Module):
@@ -88,17 +96,24 @@ def create_sharded_model(model_ctor, rngs, mesh):
 
 class CheckpointManagerTest(parameterized.TestCase):
 
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    cls.device_count = jax.device_count()
+    cls.mesh = jax.sharding.Mesh(
+        devices=np.array(jax.devices()).reshape(2, cls.device_count // 2),
+        axis_names=('fsdp', 'tp'),
+    )
+    # Shard the model once, each test works on its own clone.
+    cls.base_model, _ = create_sharded_model(TestModel, nnx.Rngs(0), cls.mesh)
+
   def setUp(self):
     super().setUp()
     try:
       self.temp_path = self.create_tempdir().full_path
     except Exception:
       self.temp_path = tempfile.TemporaryDirectory().name
-    self.device_count = jax.device_count()
-    self.mesh = jax.sharding.Mesh(
-        devices=np.array(jax.devices()).reshape(2, self.device_count // 2),
-        axis_names=('fsdp', 'tp'),
-    )
+    self.model = nnx.clone(type(self).base_model)
 
   def test_empty_root_directory(self):
     peft_checkpoint_manager = checkpoint_manager.CheckpointManager(
@@ -122,7 +137,7 @@ class CheckpointManagerTest(parameterized.TestCase):
     peft_checkpoint_manager = checkpoint_manager.CheckpointManager(
         self.temp_path
     )
-    model, _ = create_sharded_model(TestModel, nnx.Rngs(0), self.mesh)
+    model = self.model
 
     # Save the model state.
     self.assertTrue(peft_checkpoint_manager.save(1, model))
@@ -137,14 +152,14 @@ class CheckpointManagerTest(parameterized.TestCase):
     peft_checkpoint_manager = checkpoint_manager.CheckpointManager(
         self.temp_path
     )
-    model, _ = create_sharded_model(TestModel, nnx.Rngs(0), self.mesh)
+    model = self.model
     expected_state = nnx.state(model)
 
     # Save the model params.
     self.assertTrue(peft_checkpoint_manager.save(1, model))
 
     # Change the model state.
-    changed_state = jax.tree.map(lambda x: x + 1, nnx.state(model))
+    changed_state = _inc(nnx.state(model))
     nnx.update(model, changed_state)
 
     # Restore the model params.
@@ -161,7 +176,7 @@ class CheckpointManagerTest(parameterized.TestCase):
         self.temp_path
     )
     unsharded_model = TestModel(nnx.Rngs(0))
-    model, _ = create_sharded_model(TestModel, nnx.Rngs(0), self.mesh)
+    model = self.model
 
     # Save the model params.
     self.assertTrue(peft_checkpoint_manager.save(1, unsharded_model))
@@ -199,7 +214,7 @@ class CheckpointManagerTest(parameterized.TestCase):
     peft_checkpoint_manager = checkpoint_manager.CheckpointManager(
         self.temp_path
     )
-    model, _ = create_sharded_model(TestModel, nnx.Rngs(0), self.mesh)
+    model = self.model
     lora_provider = qwix.LoraProvider(
         module_path='.*w1',
         rank=4,
@@ -220,7 +235,7 @@ class CheckpointManagerTest(parameterized.TestCase):
     )
 
     # Change the model state.
-    changed_state = jax.tree.map(lambda x: x + 1, nnx.state(model))
+    changed_state = _inc(nnx.state(model))
     nnx.update(model, changed_state)
 
     # Restore the model lora params.
@@ -245,7 +260,7 @@ class CheckpointManagerTest(parameterized.TestCase):
 
   def test_save_and_restore_with_custom_metadata(self):
     ckpt_manager = checkpoint_manager.CheckpointManager(self.temp_path)
-    model, _ = create_sharded_model(TestModel, nnx.Rngs(0), self.mesh)
+    model = self.model
     custom_metadata = {'foo': 1, 'bar': 2}
     ckpt_manager.save(1, model, custom_metadata=custom_metadata)
     restored_step, restored_metadata = ckpt_manager.maybe_restore(model)
@@ -260,10 +275,10 @@ class CheckpointManagerTest(parameterized.TestCase):
     ckpt_manager = checkpoint_manager.CheckpointManager(
         os.path.join(os.path.dirname(__file__), ckpt_path)
     )
-    model, _ = create_sharded_model(TestModel, nnx.Rngs(0), self.mesh)
+    model = self.model
     expected_state = nnx.state(model)
     # Change the model state.
-    changed_state = jax.tree.map(lambda x: x + 1, nnx.state(model))
+    changed_state = _inc(nnx.state(model))
     nnx.update(model, changed_state)
 
     # Restore the model params.
@@ -25,7 +25,6 @@ from tunix.rl import common
 from tunix.sft.dpo import dpo_trainer as dpo_lib
 from tunix.tests import test_common as tc
 
-jax.config.update("jax_threefry_partitionable", False)
 # jax.config.update("jax_debug_nans", True) # useful for debugging NaN
 
 
@@ -43,23 +42,22 @@ class MySource(grain.RandomAccessDataSource):
 
 def _dummy_dataset(
     source: MySource,
-    prompt_ids: np.ndarray,
-    prompt_mask: np.ndarray,
-    chosen_ids: np.ndarray,
-    chosen_mask: np.ndarray,
-    rejected_ids: np.ndarray,
-    rejected_mask: np.ndarray,
+    prompt_ids: jax.Array | np.ndarray,
+    prompt_mask: jax.Array | np.ndarray,
+    chosen_ids: jax.Array | np.ndarray,
+    chosen_mask: jax.Array | np.ndarray,
+    rejected_ids: jax.Array | np.ndarray,
+    rejected_mask: jax.Array | np.ndarray,
 ):
-  return grain.MapDataset.source(source).map(
-      lambda x: dpo_lib.TrainingInput(
-          prompt_ids=prompt_ids,
-          prompt_mask=prompt_mask,
-          chosen_ids=chosen_ids,
-          chosen_mask=chosen_mask,
-          rejected_ids=rejected_ids,
-          rejected_mask=rejected_mask,
-      )
+  training_input = dpo_lib.TrainingInput(
+      prompt_ids=prompt_ids,
+      prompt_mask=prompt_mask,
+      chosen_ids=chosen_ids,
+      chosen_mask=chosen_mask,
+      rejected_ids=rejected_ids,
+      rejected_mask=rejected_mask,
   )
+  return grain.MapDataset.source(source).map(lambda x: training_input)
 
 
 def _dummy_string_dataset(
@@ -69,27 +67,34 @@ def _dummy_string_dataset(
     rejected_responses: np.ndarray,
     return_dict=False,
 ):
-  ds = grain.MapDataset.source(source)
   if return_dict:
-    return ds.map(
-        lambda x: {
-            "prompts": prompts,
-            "chosen_responses": chosen_responses,
-            "rejected_responses": rejected_responses,
-        }
-    )
+    payload = {
+        "prompts": prompts,
+        "chosen_responses": chosen_responses,
+        "rejected_responses": rejected_responses,
+    }
   else:
-    return ds.map(
-        lambda x: dpo_lib.DataInput(
-            prompts=prompts,
-            chosen_responses=chosen_responses,
-            rejected_responses=rejected_responses,
-        )
+    payload = dpo_lib.DataInput(
+        prompts=prompts,
+        chosen_responses=chosen_responses,
+        rejected_responses=rejected_responses,
     )
+  return grain.MapDataset.source(source).map(lambda x: payload)
 
 
 class DPOTrainerTest(parameterized.TestCase):
 
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    # Fixed logps for `test_dpo_loss_fn`, built once on device. Created here
+    # rather than at import time so the JAX backend isn't initialized early.
+    rng = np.random.RandomState(0)
+    cls.per_token_logps = jnp.asarray(rng.normal(0, 5, size=(8, 4)))
+    cls.ref_per_token_logps = jnp.asarray(
+        rng.normal(0, 5, size=(8, 4)).sum(axis=-1)
+    )
+
   @parameterized.named_parameters(
       dict(
           testcase_name="with_ref_model",
@@ -122,6 +127,15 @@ class DPOTrainerTest(parameterized.TestCase):
       rejected_mask,
       use_ref_model,
   ):
+    # Move the constant inputs to device once, instead of on every step.
+    inputs = jax.device_put((
+        prompt_ids,
+        prompt_mask,
+        chosen_ids,
+        chosen_mask,
+        rejected_ids,
+        rejected_mask,
+    ))
     model = tc.ToyTransformer(rngs=nnx.Rngs(0))
     original_variables = jax.tree.map(jnp.copy, nnx.state(model, nnx.Param))
     ref_model = None
@@ -137,24 +151,8 @@ class DPOTrainerTest(parameterized.TestCase):
         optimizer=optax.sgd(1e-3),
         training_config=dpo_config,
     )
-    train_ds = _dummy_dataset(
-        MySource(np.arange(10)),
-        prompt_ids,
-        prompt_mask,
-        chosen_ids,
-        chosen_mask,
-        rejected_ids,
-        rejected_mask,
-    )
-    eval_ds = _dummy_dataset(
-        MySource(np.arange(2)),
-        prompt_ids,
-        prompt_mask,
-        chosen_ids,
-        chosen_mask,
-        rejected_ids,
-        rejected_mask,
-    )
+    train_ds = _dummy_dataset(MySource(np.arange(10)), *inputs)
+    eval_ds = _dummy_dataset(MySource(np.arange(2)), *inputs)
     dpo_trainer.train(train_ds, eval_ds=eval_ds)
 
     variables = nnx.state(model, nnx.Param)
@@ -227,11 +225,10 @@ class DPOTrainerTest(parameterized.TestCase):
 
     variables = nnx.state(model, nnx.Param)
     jax.tree.map_with_path(tc.assert_not_equal, original_variables, variables)
-    if ref_model is not None:
-      ref_variables = nnx.state(ref_model, nnx.Param)
-      jax.tree.map_with_path(
-          tc.assert_equal, original_ref_variables, ref_variables
-      )
+    ref_variables = nnx.state(ref_model, nnx.Param)
+    jax.tree.map_with_path(
+        tc.assert_equal, original_ref_variables, ref_variables
+    )
 
     for metric_name in [
         "rewards/chosen",
@@ -245,22 +242,19 @@ class DPOTrainerTest(parameterized.TestCase):
       )
 
   def test_dpo_loss_fn(self):
-    np.random.seed(0)
     model = tc.ToyTransformer(rngs=nnx.Rngs(0))
-    per_token_logps = np.random.normal(0, 5, size=(8, 4))
-    ref_per_token_logps = np.random.normal(0, 5, size=(8, 4)).sum(axis=-1)
     train_example = dpo_lib.TrainExample(
         input_ids=jnp.arange(0, 32).reshape(8, 4),
         positions=jnp.ones((8, 4)),
         attention_mask=jnp.ones((8, 4, 4)),
-        ref_chosen_logps=ref_per_token_logps[:4],
-        ref_rejected_logps=ref_per_token_logps[4:],
+        ref_chosen_logps=self.ref_per_token_logps[:4],
+        ref_rejected_logps=self.ref_per_token_logps[4:],
         logits_to_keep=4,
         completion_mask=jnp.ones((8, 4)),
     )
 
     with mock.patch.object(
-        common, "get_per_token_logps", return_value=jnp.array(per_token_logps)
+        common, "get_per_token_logps", return_value=self.per_token_logps
     ):
       loss, _ = dpo_lib.dpo_loss_fn(model, train_example, 0.1, 0)
       np.testing.assert_allclose(loss, 0.753059, atol=1e-5)
@@ -271,12 +265,14 @@ class DPOTrainerTest(parameterized.TestCase):
   def test_dpo_prepare_inputs_for_strings(self):
     tokenizer = tc.MockVocab()
 
-    model = tc.ToyTransformer(
-        rngs=nnx.Rngs(0), vocab_size=tokenizer.GetPieceSize()
-    )
-    ref_model = tc.ToyTransformer(
-        rngs=nnx.Rngs(0), vocab_size=tokenizer.GetPieceSize()
-    )
+    # The expected ref logps depend on the non-partitionable threefry init.
+    with jax.threefry_partitionable(False):
+      model = tc.ToyTransformer(
+          rngs=nnx.Rngs(0), vocab_size=tokenizer.GetPieceSize()
+      )
+      ref_model = tc.ToyTransformer(
+          rngs=nnx.Rngs(0), vocab_size=tokenizer.GetPieceSize()
+      )
     dpo_trainer = dpo_lib.DPOTrainer(
         model=model,
         ref_model=ref_model,
@@ -328,8 +324,10 @@ class DPOTrainerTest(parameterized.TestCase):
     self.assertEqual(out.logits_to_keep, 3)
 
   def test_dpo_prepare_inputs(self):
-    model = tc.ToyTransformer(rngs=nnx.Rngs(0))
-    ref_model = tc.ToyTransformer(rngs=nnx.Rngs(0))
+    # The expected ref logps depend on the non-partitionable threefry init.
+    with jax.threefry_partitionable(False):
+      model = tc.ToyTransformer(rngs=nnx.Rngs(0))
+      ref_model = tc.ToyTransformer(rngs=nnx.Rngs(0))
     dpo_trainer = dpo_lib.DPOTrainer(
         model=model,
         ref_model=ref_model,